@@ -1,8 +1,11 @@
-from enum import Enum
+from dataclasses import dataclass
+from enum import Enum, IntEnum
+from functools import lru_cache
 from pydantic import BaseModel
 from typing import Self, Tuple
 import re
 import rich
+from rich.markup import escape
 from rich.table import Table
 import typer
 from pathlib import Path
@@ -14,8 +17,10 @@ CODE_UNDERLINE = "n"
 CODE_ITALIC = "o"
 CODE_RESET = "r"
 
+COLOR_CODES = "0123456789abcdef"
+
 STYLE_CODES = (
-    "0123456789abcdef"
+    COLOR_CODES
     + CODE_OBFUSCATED
     + CODE_BOLD
     + CODE_STRIKETHROUGH
@@ -24,9 +29,33 @@ STYLE_CODES = (
     + CODE_RESET
 )
 
-
-class TextStyle(BaseModel):
-    color: str = "0"
+# Matches an unpaired "%" or a "§" followed by anything but a known code.
+INVALID_CODE_PATTERN = re.compile(rf"(?<!%)(?:%%)*%[^n%\n]|§[^{STYLE_CODES}\n]")
+
+
+class ColorCode(IntEnum):
+    BLACK = 0
+    DARK_BLUE = 1
+    DARK_GREEN = 2
+    DARK_AQUA = 3
+    DARK_RED = 4
+    DARK_PURPLE = 5
+    GOLD = 6
+    GRAY = 7
+    DARK_GRAY = 8
+    BLUE = 9
+    GREEN = 10
+    AQUA = 11
+    RED = 12
+    LIGHT_PURPLE = 13
+    YELLOW = 14
+    WHITE = 15
+    ENDLINE = 16
+
+
+@dataclass(slots=True, frozen=True)
+class TextStyle:
+    color: ColorCode = ColorCode.BLACK
     is_bold: bool = False
     is_italic: bool = False
     is_underline: bool = False
@@ -34,59 +63,89 @@ class TextStyle(BaseModel):
     is_obfuscated: bool = False
 
 
-class TextEntry(BaseModel):
+@dataclass(slots=True, frozen=True)
+class TextEntry:
     style: TextStyle
     content: str
 
     def can_be_ignored(self) -> bool:
-        return self.style.color == "0"
+        return self.style.color == ColorCode.BLACK
+
+
+# Styles and entries are immutable, so identical ones can share one instance.
+DEFAULT_TEXT_STYLE = TextStyle()
+
+TEXT_STYLE_BY_CHAR = {
+    char: TextStyle(color=ColorCode(i)) for i, char in enumerate(COLOR_CODES)
+}
+TEXT_STYLE_BY_CHAR[CODE_RESET] = DEFAULT_TEXT_STYLE
+
+ENDLINE_TEXT_ENTRY = TextEntry(style=TextStyle(color=ColorCode.ENDLINE), content="%n")
 
 
 class Article(BaseModel):
     texts: list[TextEntry]
+    # Colors of `texts`, kept in their own list so that diffing only has to
+    # walk small ints.
+    colors: list[ColorCode]
 
     @staticmethod
     def raise_if_invalid(raw_article: str) -> None:
-        invalid_matches = re.findall(r"%(.)", raw_article)
-        for match in invalid_matches:
-            if match[0] not in ["n", "%"]:
-                rich.print(f'[red]Invalid matches: "%{match[0]}"[/red]')
-                raise ValueError(f'Invalid matches: "%{match[0]}"')
-
-        invalid_matches = re.findall(r"§(.)", raw_article)
-        for match in invalid_matches:
-            if match[0] not in STYLE_CODES:
-                rich.print(f'[red]Invalid matches: "§{match[0]}"[/red]')
-                raise ValueError(f'Invalid matches: "§{match[0]}"')
+        match = INVALID_CODE_PATTERN.search(raw_article)
+        if match is not None:
+            invalid_code = match[0][-2:]
+            line_number = raw_article.count("%n", 0, match.end() - 2) + 1
+            raise ValueError(f'Invalid matches: "{invalid_code}" (line {line_number})')
 
     @classmethod
     def parse_questbook_string(cls, raw_article: str) -> Self:
         cls.raise_if_invalid(raw_article)
 
         texts: list[TextEntry] = []
+        colors: list[ColorCode] = []
+
+        # Lines are sliced out one at a time instead of splitting the whole
+        # article up front, so only one line is held in memory at once.
+        line_start = 0
+        while line_start >= 0:
+            line_end = raw_article.find("%n", line_start)
+            if line_end >= 0:
+                line = raw_article[line_start:line_end]
+                next_line_start = line_end + 2
+            else:
+                line = raw_article[line_start:]
+                next_line_start = -1
 
-        text_lines = raw_article.split("%n")
-        for line in text_lines:
             if texts:
-                texts.append(TextEntry(style=TextStyle(color="ENDLINE"), content="%n"))
+                texts.append(ENDLINE_TEXT_ENTRY)
+                colors.append(ColorCode.ENDLINE)
+
+            current_style = DEFAULT_TEXT_STYLE
+
+            head, *parts = line.split("§")
+            if head:
+                texts.append(TextEntry(style=current_style, content=head))
+                colors.append(current_style.color)
 
-            current_color: str = "0"
+            for part in parts:
+                if not part:
+                    continue
 
-            text_matches = re.findall(r"(§[0-9a-fr])|([^§]+)", line)
-            for match in text_matches:
-                if match[0]:
-                    if match[0][1] == "r":
-                        current_color = "0"
-                    else:
-                        current_color = match[0][1]
+                style = TEXT_STYLE_BY_CHAR.get(part[0])
+                if style is None:
+                    # Format codes are kept as text, as only colors are checked.
+                    content = part
                 else:
-                    texts.append(
-                        TextEntry(
-                            style=TextStyle(color=current_color), content=match[1]
-                        )
-                    )
+                    current_style = style
+                    content = part[1:]
+
+                if content:
+                    texts.append(TextEntry(style=current_style, content=content))
+                    colors.append(current_style.color)
+
+            line_start = next_line_start
 
-        return cls(texts=texts)
+        return cls.model_construct(texts=texts, colors=colors)
 
 
 def input_until_not_empty(prompt: str) -> str:
@@ -96,89 +155,121 @@ def input_until_not_empty(prompt: str) -> str:
             return user_input
 
 
-def format_text(
-    text: TextEntry | None, style: str | None = None, *, is_color_all: bool = True
+@lru_cache(maxsize=65536)
+def format_colored_text(
+    color: ColorCode, content: str, style: str | None, is_color_all: bool
 ) -> str:
-    if isinstance(text, TextEntry):
-        if text.style.color == "ENDLINE":
-            return f"[{style}]{text.content}[/{style}]" if style else text.content
+    if color == ColorCode.ENDLINE:
+        return f"[{style}]{content}[/{style}]" if style else content
 
-        color_as_str: str = f"§{text.style.color}"
-        content_as_str: str = text.content
+    color_as_str: str = f"§{COLOR_CODES[color]}"
 
-        if style is not None:
-            if is_color_all:
-                return f"[{style}]{color_as_str}{content_as_str}[/{style}]"
-            else:
-                return f"[{style}]{color_as_str}[/{style}]{content_as_str}"
+    if style is not None:
+        if is_color_all:
+            return f"[{style}]{color_as_str}{content}[/{style}]"
         else:
-            return f"{color_as_str}{content_as_str}"
+            return f"[{style}]{color_as_str}[/{style}]{content}"
+    else:
+        return f"{color_as_str}{content}"
+
+
+def format_text(
+    text: TextEntry | None, style: str | None = None, *, is_color_all: bool = True
+) -> str:
+    if isinstance(text, TextEntry):
+        return format_colored_text(text.style.color, text.content, style, is_color_all)
     else:
         return f"[{style}]{str(text)}[/{style}]" if style else str(text)
 
 
-def get_diff(article_1: Article, article_2: Article) -> Tuple[bool, Table]:
-    table = Table(title="diff", show_lines=True)
-    table.add_column("Article 1", overflow="fold")
-    table.add_column("Article 2", overflow="fold")
+def is_consistent(article_1: Article, article_2: Article) -> bool:
+    # get_diff pairs up the entries that cannot be ignored in order, so the
+    # articles are consistent exactly when those entries have equal colors.
+    colors_1 = [color for color in article_1.colors if color != ColorCode.BLACK]
+    colors_2 = [color for color in article_2.colors if color != ColorCode.BLACK]
+    return colors_1 == colors_2
+
 
+def get_diff(article_1: Article, article_2: Article) -> Tuple[bool, Table]:
+    rows: list[tuple[str, str]] = []
     success: bool = True
 
+    texts_1 = article_1.texts
+    texts_2 = article_2.texts
+    colors_1 = article_1.colors
+    colors_2 = article_2.colors
     index_1 = 0
     index_2 = 0
 
-    def a() -> TextEntry:
-        return article_1.texts[index_1]
-
-    def b() -> TextEntry:
-        return article_2.texts[index_2]
-
-    while index_1 < len(article_1.texts) and index_2 < len(article_2.texts):
-        if a().can_be_ignored() and b().can_be_ignored():
-            # Both are normal text and accepted.
-            table.add_row(format_text(a()), format_text(b()))
-            index_1 += 1
-            index_2 += 1
-
-        elif a().can_be_ignored() and not b().can_be_ignored():
-            # en() is normal text, tr() is not.
-            table.add_row(format_text(a(), style="yellow", is_color_all=True), "")
-            index_1 += 1
+    while index_1 < len(colors_1) and index_2 < len(colors_2):
+        color_1 = colors_1[index_1]
+        color_2 = colors_2[index_2]
+        # Branch on each side's color once, so every step makes exactly two
+        # comparisons to pick one of the four cases.
+        if color_1 == ColorCode.BLACK:
+            if color_2 == ColorCode.BLACK:
+                # Both are normal text and accepted.
+                rows.append(
+                    (format_text(texts_1[index_1]), format_text(texts_2[index_2]))
+                )
+                index_1 += 1
+                index_2 += 1
+            else:
+                # en() is normal text, tr() is not.
+                text_1 = texts_1[index_1]
+                rows.append(
+                    (format_text(text_1, style="yellow", is_color_all=True), "")
+                )
+                index_1 += 1
 
-        elif not a().can_be_ignored() and b().can_be_ignored():
+        elif color_2 == ColorCode.BLACK:
             # en() is not normal text, tr() is normal text.
-            table.add_row("", format_text(b(), style="yellow", is_color_all=True))
+            rows.append(
+                ("", format_text(texts_2[index_2], style="yellow", is_color_all=True))
+            )
             index_2 += 1
 
         else:
             # both are not normal text.
-            if a().style == b().style:
-                table.add_row(format_text(a()), format_text(b()))
+            text_1 = texts_1[index_1]
+            text_2 = texts_2[index_2]
+            if color_1 == color_2:
+                rows.append((format_text(text_1), format_text(text_2)))
             else:
-                table.add_row(
-                    format_text(a(), style="red bold", is_color_all=False),
-                    format_text(b(), style="green bold", is_color_all=False),
+                rows.append(
+                    (
+                        format_text(text_1, style="red bold", is_color_all=False),
+                        format_text(text_2, style="green bold", is_color_all=False),
+                    )
                 )
                 success = False
             index_1 += 1
             index_2 += 1
 
-    while index_2 < len(article_2.texts):
-        if b().style.color == "0":
-            table.add_row("", format_text(b(), style="yellow", is_color_all=True))
+    while index_2 < len(colors_2):
+        text_2 = texts_2[index_2]
+        if colors_2[index_2] == ColorCode.BLACK:
+            rows.append(("", format_text(text_2, style="yellow", is_color_all=True)))
         else:
-            table.add_row("", format_text(b(), style="red bold", is_color_all=False))
+            rows.append(("", format_text(text_2, style="red bold", is_color_all=False)))
             success = False
         index_2 += 1
 
-    while index_1 < len(article_1.texts):
-        if a().style.color == "0":
-            table.add_row(format_text(a(), style="yellow", is_color_all=True), "")
+    while index_1 < len(colors_1):
+        text_1 = texts_1[index_1]
+        if colors_1[index_1] == ColorCode.BLACK:
+            rows.append((format_text(text_1, style="yellow", is_color_all=True), ""))
         else:
-            table.add_row(format_text(a(), style="red bold", is_color_all=False), "")
+            rows.append((format_text(text_1, style="red bold", is_color_all=False), ""))
             success = False
         index_1 += 1
 
+    table = Table(title="diff", show_lines=True)
+    table.add_column("Article 1", overflow="fold")
+    table.add_column("Article 2", overflow="fold")
+    for row in rows:
+        table.add_row(*row)
+
     return success, table
 
 
@@ -198,18 +289,29 @@ def main(
     file1_raw = file1.read_text(encoding="utf-8")
     file2_raw = file2.read_text(encoding="utf-8")
 
-    article1 = Article.parse_questbook_string(file1_raw)
-    article2 = Article.parse_questbook_string(file2_raw)
+    try:
+        article1 = Article.parse_questbook_string(file1_raw)
+        article2 = Article.parse_questbook_string(file2_raw)
+    except ValueError as error:
+        rich.print(f"[red]{escape(str(error))}[/red]")
+        raise typer.Exit(code=1)
+
+    # Only build the table when it is going to be printed.
+    table: Table | None = None
+    if show_table == ShowTableEnum.ALWAYS:
+        success, table = get_diff(article1, article2)
+    else:
+        success = is_consistent(article1, article2)
+        if not success and show_table == ShowTableEnum.ON_ERROR:
+            _, table = get_diff(article1, article2)
 
-    success, table = get_diff(article1, article2)
     if success:
         rich.print("[green]Articles are consistent![/green]")
-        if show_table == ShowTableEnum.ALWAYS:
-            rich.print(table)
     else:
         rich.print("[red]Articles are not consistent![/red]")
-        if show_table in [ShowTableEnum.ALWAYS, ShowTableEnum.ON_ERROR]:
-            rich.print(table)
+
+    if table is not None:
+        rich.print(table)
 
 
 if __name__ == "__main__":